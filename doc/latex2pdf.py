@@ -35,16 +35,29 @@ Author: Michael Risbeck <risbeck@wisc.edu>
 
 import argparse
 import collections
-import hashlib
+import contextlib
 import functools
+import itertools
+import mmap
 import os
 import re
 import shlex
+import stat
 import string
 import subprocess
 import sys
-import tempfile
-import traceback
+import time
+
+# Modules that are not needed on the fast paths (in particular the state-file
+# "already up to date" exit) are imported lazily at their first use to keep
+# cold start down; this script often runs once per file inside make.
+
+# Optional inotify support (Linux only). When available, the kernel tells us
+# exactly which files pdflatex touched, so we don't have to rescan everything.
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
 
 # Helper function for parser.
 def getfilecheck(ext=None, directory=False, exists=True, toAbs=False):
@@ -90,6 +103,8 @@ optargs.add_argument("--min-runs", help="minimum number of pdflatex runs",
                     type=int, default=1)
 optargs.add_argument("--max-runs", help="maximum number of pdflatex runs",
                     type=int, default=4)
+optargs.add_argument("--jobs", help="max number of concurrent bibtex runs",
+                    type=int, default=os.cpu_count() or 1)
 optargs.add_argument("--display", help="set display level (default: errors)",
                     choices=set(["all","some","errors","none"]),
                     default="errors")
@@ -101,6 +116,9 @@ advargs.add_argument("--flags",help="flags to pdflatex",
                      default="--synctex=1  --halt-on-error  --recorder")
 advargs.add_argument("--paranoid",help="run until aux files do not change",
                      action="store_true")
+advargs.add_argument("--no-draftmode", action="store_true",
+                     help="don't use pdflatex --draftmode for intermediate "
+                     "runs")
 advargs.add_argument("--check-all-aux", action="store_true",
                      help="consider all aux files in the directory, not just "
                      "those explicitly mentioned in the log file.")
@@ -116,6 +134,9 @@ advargs.add_argument("--ignore-cite-errors", action="store_true",
                      help="ignore citation errors on final run")
 advargs.add_argument("--keep-pdf-timestamp", action="store_true",
                      help="Don't adjust pdf timestamp on error (see below)")
+advargs.add_argument("--no-state-file", action="store_true",
+                     help="don't read or write the state file that lets "
+                     "repeat invocations skip pdflatex entirely")
 
 reqargs = parser.add_argument_group("required arguments")
 reqargs.add_argument("texfile",help="source .tex file",
@@ -127,8 +148,76 @@ parser.add_argument("--DEFAULT-FLAGS", help=argparse.SUPPRESS,
                     default="--interaction=nonstopmode")
 
 
+# Timestamps are integer nanoseconds (st_mtime_ns) so that comparisons are
+# exact; float mtimes can flicker on filesystems with sub-second resolution
+# and trigger spurious rescans. These sentinels replace -inf/inf for files
+# that don't exist.
+mintime = -2**63
+maxtime = 2**63 - 1
+
+
 # Some helper functions.
-openlog = functools.partial(open, mode="r", encoding="ascii", errors="replace")
+def readlog(filename):
+    """Reads an entire log file and returns its contents as one string."""
+    with open(filename, "rb") as f:
+        return f.read().decode("ascii", errors="replace")
+
+
+def readsmall(filename):
+    """
+    Reads an entire (small) file with low-level os calls and returns bytes.
+
+    The file is opened with O_NOATIME where permitted so the read doesn't
+    trigger an atime write; the flag is refused for files we don't own, in
+    which case we retry without it.
+    """
+    flags = os.O_RDONLY | getattr(os, "O_NOATIME", 0)
+    try:
+        fd = os.open(filename, flags)
+    except PermissionError:
+        fd = os.open(filename, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        data = os.read(fd, size)
+        while len(data) < size:
+            more = os.read(fd, size - len(data))
+            if len(more) == 0:
+                break
+            data += more
+    finally:
+        os.close(fd)
+    return data
+
+
+@contextlib.contextmanager
+def openmapped(filename):
+    """
+    Context manager yielding a read-only memory map of filename.
+
+    Zero-byte files cannot be mapped, so an empty bytes object is yielded
+    for them instead.
+    """
+    with open(filename, "rb") as f:
+        if os.path.getsize(filename) == 0:
+            yield b""
+        else:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                yield buf
+            finally:
+                buf.close()
+
+
+def runcommand(args, **kwargs):
+    """
+    Runs a command with subprocess.run, keeping inherited fds open.
+
+    With close_fds=False (and no other exotic options) CPython launches the
+    child via posix_spawn instead of fork+exec plus an O(max_fd) close loop.
+    Several children are spawned per pdflatex iteration, and none of them
+    need fds hidden from them, so inheriting is safe.
+    """
+    return subprocess.run(args, close_fds=False, **kwargs)
 
 
 def errorout(message="Invalid Usage", doc=False, usage=True,
@@ -142,81 +231,321 @@ def errorout(message="Invalid Usage", doc=False, usage=True,
         raise RuntimeError(message) from fromerr
 
 
-def getauxinfo(files=None, pdir=".", md5=False, ext=".aux"):
+class AuxInfo:
+    """
+    Aux file information stored as one dict per field.
+
+    All dicts are keyed by full file name. Compared to a dict of per-file
+    tuples, this stores N files in a handful of dicts instead of allocating
+    a tuple per file on every iteration of the main loop.
+
+    Fields are relpath, exists, timestamp (integer nanoseconds), bibdata
+    (tuple of bib file names), and digest (HashThunk or None).
+    """
+    fields = ("relpath", "exists", "timestamp", "bibdata", "digest")
+
+    def __init__(self):
+        """Initializes all field dicts as empty."""
+        for field in self.fields:
+            setattr(self, field, {})
+
+    def add(self, f, relpath, exists, timestamp, bibdata, digest):
+        """Adds (or replaces) the entry for file f."""
+        self.relpath[f] = relpath
+        self.exists[f] = exists
+        self.timestamp[f] = timestamp
+        self.bibdata[f] = bibdata
+        self.digest[f] = digest
+
+    def copyfrom(self, other, f):
+        """Copies file f's entry from other into self."""
+        for field in self.fields:
+            getattr(self, field)[f] = getattr(other, field)[f]
+
+    def update(self, other):
+        """Merges all of other's entries into self."""
+        for field in self.fields:
+            getattr(self, field).update(getattr(other, field))
+
+    def __contains__(self, f):
+        return f in self.relpath
+
+    def __iter__(self):
+        return iter(self.relpath)
+
+    def __len__(self):
+        return len(self.relpath)
+
+
+# Cache of parsed aux file contents keyed by file name. Values are tuples
+# (timestamp, size, bibdata, thunk) so that files whose timestamp and size
+# have not changed between pdflatex runs are not re-read or re-hashed. The
+# thunk is a HashThunk (or None if no hash was requested), so digests carry
+# over between iterations once computed. Entries for files that vanish are
+# dropped lazily the next time the file is looked up and found missing.
+auxcache = {}
+
+
+def scandirstats(pdir):
     """
-    Returns a dictionary with AuxFile named tuples for each element of files.
+    Lists a directory with os.scandir and returns (names, stats).
+
+    stats maps full (normalized) paths to os.stat_result objects taken from
+    the scandir cache, which avoids issuing a separate stat call per file.
+    """
+    names = []
+    stats = {}
+    with os.scandir(pdir) as entries:
+        for entry in entries:
+            names.append(entry.name)
+            try:
+                stats[os.path.normpath(entry.path)] = entry.stat()
+            except OSError:
+                pass
+    return (names, stats)
 
-    If files is None, gets a list of all files in pdir.
+
+def getauxinfo(files=None, pdir=".", digest=False, ext=".aux", stats=None,
+               newerthan=None):
+    """
+    Returns an AuxInfo object covering each element of files.
+
+    If files is None, gets a list of all files in pdir via os.scandir.
+    Callers that have already stat'd some files can pass stats (a dict from
+    full path to os.stat_result) to avoid repeating those calls. newerthan
+    (integer nanoseconds) marks the start of the most recent pdflatex run:
+    cached files not modified since then are known to be untouched and are
+    reused without any further checks.
     """
+    if stats is None:
+        stats = {}
     if files is None:
-        files = os.listdir(pdir)
-    files = getfullpaths(files, pdir)
-    auxinfo = {}
+        (files, scanstats) = scandirstats(pdir)
+        stats.update(scanstats)
+    # Callers paste lists together (log scan plus directory listing), so
+    # drop duplicates while keeping order to avoid stat'ing a file twice.
+    files = dict.fromkeys(getfullpaths(files, pdir))
+    auxinfo = AuxInfo()
+    wantdigest = digest
     for f in filter(lambda f: f.endswith(ext), files):
         relpath = os.path.relpath(f,pdir)
-        exists = os.path.isfile(f)
+        st = stats.get(f)
+        if st is None:
+            try:
+                st = os.stat(f)
+            except OSError:
+                st = None
+        exists = st is not None and stat.S_ISREG(st.st_mode)
         if exists:
-            timestamp = os.path.getmtime(f)
-            bibdata = getbibdata(f)
-            md5 = md5sum(f) if md5 else None
+            timestamp = st.st_mtime_ns
+            size = st.st_size
+            cached = auxcache.get(f)
+            untouched = (newerthan is not None and timestamp < newerthan)
+            if cached is not None and (untouched
+                                       or cached[:2] == (timestamp, size)):
+                (_, _, bibdata, digest) = cached
+                if wantdigest and digest is None:
+                    digest = HashThunk(f)
+            else:
+                bibdata = getbibdata(f)
+                digest = HashThunk(f) if wantdigest else None
+            auxcache[f] = (timestamp, size, bibdata, digest)
         else:
-            timestamp = -float("inf")
+            auxcache.pop(f, None)
+            timestamp = mintime
             bibdata = tuple()
-            md5 = None
-        auxinfo[f] = AuxFile(relpath, exists, timestamp, bibdata, md5)
+            digest = None
+        auxinfo.add(f, relpath, exists, timestamp, bibdata, digest)
     return auxinfo
 
 
-def getindexfiles(logfile):
+# Name of the file used to persist state between invocations.
+statefilename = ".latex2pdf_state.json"
+
+
+def loadstate(pdir):
+    """
+    Loads the saved state from pdir, returning an empty dict if anything
+    goes wrong (no state file, unreadable, corrupt, ...).
+    """
+    import json
+    try:
+        with open(os.path.join(pdir, statefilename), "r") as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        state = {}
+    return state
+
+
+def getflsinputs(flsfile, pdir):
+    """
+    Returns the set of INPUT files recorded in a pdflatex .fls file.
+
+    The .fls file is written by pdflatex --recorder and names every file
+    the run opened: included tex files, images, styles, fonts, and so on.
+    Relative paths are resolved against the PWD entry (pdir if there is
+    none). Returns None if the file cannot be read, e.g. when --recorder
+    has been removed from the pdflatex flags.
+    """
+    try:
+        data = readsmall(flsfile)
+    except OSError:
+        return None
+    inputs = set()
+    cwd = pdir
+    for line in data.decode("ascii", errors="replace").splitlines():
+        if line.startswith("PWD "):
+            cwd = line[4:]
+        elif line.startswith("INPUT "):
+            inputs.add(os.path.normpath(os.path.join(cwd, line[6:])))
+    return inputs
+
+
+def savestate(pdir, texfile, pdffile, auxinfo, bibfiles, success):
+    """
+    Saves build state to pdir for the next invocation.
+
+    Records timestamps and sizes of the tex source, pdf output, aux files,
+    bib files, and every input named in the .fls recorder file, plus each
+    aux file's bibdata and any digest that was actually computed. If the
+    recorder file is missing, edits to included files could go unseen, so
+    the state is marked unsuccessful and the next invocation will not skip.
+    Failures to write are silently ignored; the state file is only an
+    optimization.
+    """
+    base = os.path.splitext(os.path.basename(texfile))[0]
+    inputs = getflsinputs(os.path.join(pdir, base + ".fls"), pdir)
+    if inputs is None:
+        success = False
+        inputs = ()
+    files = {}
+    for f in itertools.chain(auxinfo, bibfiles, inputs):
+        if f in files:
+            continue
+        try:
+            st = os.stat(f)
+        except OSError:
+            continue
+        thunk = auxinfo.digest.get(f)
+        files[f] = dict(mtime=st.st_mtime_ns, size=st.st_size,
+                        bibdata=list(auxinfo.bibdata.get(f, ())),
+                        digest=None if thunk is None else thunk.digest)
+    import json
+    state = dict(texfile=texfile, texmtime=getmtime(texfile),
+                 pdfmtime=getmtime(pdffile), success=success, files=files)
+    try:
+        with open(os.path.join(pdir, statefilename), "w") as f:
+            json.dump(state, f, indent=1)
+    except OSError:
+        pass
+
+
+def stateuptodate(state, texfile, pdffile):
+    """
+    Returns True if the saved state shows there is nothing to do.
+
+    This requires that the previous run succeeded on the same tex file, the
+    pdf still exists, and the tex source and every recorded file still have
+    their saved timestamp and size.
+    """
+    if not state.get("success") or state.get("texfile") != texfile:
+        return False
+    if getmtime(texfile) != state.get("texmtime"):
+        return False
+    if (not os.path.isfile(pdffile)
+            or getmtime(pdffile) != state.get("pdfmtime")):
+        return False
+    for (f, info) in state.get("files", {}).items():
+        try:
+            st = os.stat(f)
+        except OSError:
+            return False
+        if st.st_mtime_ns != info["mtime"] or st.st_size != info["size"]:
+            return False
+    return True
+
+
+def seedauxcache(state):
+    """
+    Pre-populates the aux cache from saved state.
+
+    Aux files whose timestamp and size still match then skip the initial
+    re-read (and keep their saved digest) on the first iteration. No stat
+    verification happens here; a seeded entry is only ever used after
+    getauxinfo compares it against a fresh stat of the file.
+    """
+    for (f, info) in state.get("files", {}).items():
+        thunk = None
+        if info.get("digest") is not None:
+            thunk = HashThunk(f)
+            thunk.digest = info["digest"]
+        auxcache.setdefault(f, (info["mtime"], info["size"],
+                                tuple(info["bibdata"]), thunk))
+
+
+# Known index types and the regex to find them in the log file.
+indextypes = {
+    # output ext : (name, input ext.)
+    "idx" : ("subject", "ind"),
+    "ain" : ("author", "and"),
+    "ctx" : ("citation", "cnd"),
+}
+indexfilere = re.compile(rb"Writing index file .*\.("
+                         + "|".join(indextypes.keys()).encode("ascii") + b")")
+
+
+def getindexfiles(logfile, data=None):
     """
     Searches through a log file to find any index files.
 
-    Returns a dict with values (input ext, output ext) and string keys.
+    Returns a dict with values (input ext, output ext) and string keys. If
+    data is given, it is used as the (bytes) log contents instead of reading
+    logfile again.
     """
-    indexes = {
-        # output ext : (name, input ext.)
-        "idx" : ("subject", "ind"),
-        "ain" : ("author", "and"),
-        "ctx" : ("citation", "cnd"),
-    }
     found = {}
-    regex = re.compile(r"Writing index file .*\.({})"
-                       .format("|".join(indexes.keys())))
-    with openlog(logfile) as log:
-        for line in log:
-            s = regex.search(line)
-            if s is not None:
-                inext = s.group(1)
-                (name, outext) = indexes[inext]
-                found[name] = (inext, outext)
+    if data is None:
+        with openmapped(logfile) as buf:
+            exts = indexfilere.findall(buf)
+    else:
+        exts = indexfilere.findall(data)
+    for inext in exts:
+        inext = inext.decode("ascii")
+        (name, outext) = indextypes[inext]
+        found[name] = (inext, outext)
     return found
 
 
-def getmodifiedaux(old, new, md5=False):
+def getmodifiedaux(old, new, digest=False):
     """
-    Returns AuxFile for files changed in new.
+    Returns an AuxInfo with the files changed in new.
 
     Files not in old, files strictly newer than their counterparts in old, or
-    (if md5 is True), files whose md5 sums do not match in old.
+    (if digest is True), files whose digests do not match in old.
     """
-    changed = {}
-    for (f, aux) in new.items():
-        ischanged = (f not in old
-                     or aux.timestamp > old[f].timestamp
-                     or (md5 and aux.md5 != old[f].md5))
+    changed = AuxInfo()
+    oldtimes = old.timestamp
+    for (f, timestamp) in new.timestamp.items():
+        ischanged = (f not in oldtimes
+                     or timestamp > oldtimes[f]
+                     or (digest and new.digest[f] != old.digest[f]))
         if ischanged:
-            changed[f] = aux
+            changed.copyfrom(new, f)
     return changed
 
 
-def getauxfromlog(log, pdir=""):
+# Regex to find aux files mentioned in the log file.
+auxfilere = re.compile(rb"\((\.?/.*?\.aux)")
+
+
+def getauxfromlog(log, pdir="", data=None):
     """
     Scans through the log file and looks for aux files.
 
     Returns a list of absolute paths to aux files.
 
     Only returns a given file if it exists (with relative paths taken relative
-    to pdir).
+    to pdir). If data is given, it is used as the (bytes) log contents
+    instead of reading log again.
     """
     # Get a nice filename for printing (not used anywhere else).
     rellog = os.path.relpath(log, os.path.abspath(pdir))
@@ -224,46 +553,57 @@ def getauxfromlog(log, pdir=""):
         rellog = log
 
     # Do actual work.
+    console.debug("Opening log file <{}>.", rellog)
+    if data is None:
+        with openmapped(log) as buf:
+            names = auxfilere.findall(buf)
+    else:
+        names = auxfilere.findall(data)
     aux = set()
-    auxre = re.compile(r"\((\.?/.*?\.aux)")
-    with openlog(log) as f:
-        console.debug("Opening log file <{}>.", rellog)
-        for line in f:
-            for a in auxre.findall(line):
-                a = os.path.normpath(os.path.join(pdir, a))
-                if os.path.isfile(a):
-                    aux.add(a)
+    for a in names:
+        a = a.decode("ascii", errors="replace")
+        a = os.path.normpath(os.path.join(pdir, a))
+        if os.path.isfile(a):
+            aux.add(a)
     return list(aux)
 
 
+# Regex to find \bibdata entries in aux files.
+bibdatare = re.compile(rb"^\\bibdata\{(.*)\}", re.MULTILINE)
+
+
 def getbibdata(filename):
     """
     Searches filename for \bibdata{*} and returns bibliography files.
     """
+    data = readsmall(filename)
     bibfiles = []
-    bibdata = re.compile(r"\\bibdata\{(.*)\}")
-    f = openlog(filename)
-    for line in f:
-        m = bibdata.match(line)
-        if m is not None:
-            for b in m.group(1).split(","):
+    # Most aux files have no bibliography, so gate the regex on a plain
+    # substring check.
+    if b"\\bibdata" in data:
+        for match in bibdatare.findall(data):
+            for b in match.decode("ascii", errors="replace").split(","):
                 bibfiles.append(b.strip() + ".bib")
     return tuple(bibfiles)
 
 
-def biboutofdate(auxinfo, pdir, includeblx=True, env=None):
+def biboutofdate(auxinfo, pdir, includeblx=True, env=None, stats=None):
     """
     Check timestamps on bib files to see if bbl files need to be remade.
 
     Returns a tuple whose first entry is True/False to say whether the
     bibliography is out of date, and whose second entry is a list of full
     bibliography filenames.
+
+    As in getauxinfo, stats can hold os.stat_result objects for files the
+    caller has already stat'd.
     """
+    if stats is None:
+        stats = {}
     # Need to check any included bib files to see if they have been modified.
     bib = []
-    for aux in auxinfo.values():
-        for b in aux.bibdata:
-            bib.append(b)
+    for bibs in auxinfo.bibdata.values():
+        bib.extend(bibs)
     if not includeblx:
         bib = list(filter(lambda b : not b.endswith("-blx.bib"), bib))
     if len(bib) == 0:
@@ -271,41 +611,53 @@ def biboutofdate(auxinfo, pdir, includeblx=True, env=None):
         outofdate = False
         bibfull = []
     else:
-        # Get list of bib files and last modified timestamps.
-        bibfull = kpsewhich(bib, pdir, env=env)
-        bibtimes = [getmtime(f) for f in bibfull]
-        newestbib = safemax(bibtimes)
-
-        # Get a list of the .bbl files and timestamps.
+        # Get a list of the .bbl files and find the oldest timestamp.
         bblfull = [re.sub(".aux$",".bbl",f) for f in auxinfo]
-        bbltimes = [getmtime(f, na=float("inf")) for f in bblfull]
+        bbltimes = [stats[f].st_mtime_ns if f in stats
+                    else getmtime(f, na=maxtime) for f in bblfull]
         oldestbbl = safemin(bbltimes)
 
-        # Check whether or not everything is in date.
-        outofdate = (newestbib >= oldestbbl)
+        # Check the bib files one at a time and stop as soon as any of them
+        # is newer than the oldest bbl, which skips the remaining stat calls.
+        bibfull = kpsewhich(bib, pdir, env=env)
+        outofdate = any(getmtime(f) >= oldestbbl for f in bibfull)
     return (outofdate, bibfull)
 
 
+# Cache of kpsewhich lookups keyed by (files, directory). Spawning kpsewhich
+# costs tens of ms, and the bib list rarely changes between iterations. Note
+# that env is not part of the key; it is constant within one invocation.
+kpsecache = {}
+
+
 def kpsewhich(biblist, cwd=".", env=None):
     """
     Runs kpsewhich on a list of bib files and returns full paths for each.
-    """
-    kpse = subprocess.Popen(["kpsewhich"] + biblist, cwd=cwd,
-                            stdout=subprocess.PIPE, env=env)
-    (bibfullraw, kpsewhicherr) = kpse.communicate()
-    bibfull = getfullpaths(bibfullraw.decode().split("\n"), pdir=cwd)
-    return bibfull
 
-
-def getmtime(f, na=-float("inf")):
+    Results are cached, so repeated lookups of the same list do not spawn
+    another kpsewhich process.
+    """
+    key = (tuple(biblist), cwd)
+    bibfull = kpsecache.get(key)
+    if bibfull is None:
+        kpse = runcommand(["kpsewhich"] + biblist, cwd=cwd,
+                          stdout=subprocess.PIPE, env=env)
+        bibfull = getfullpaths(kpse.stdout.decode().split("\n"), pdir=cwd)
+        kpsecache[key] = bibfull
+    return list(bibfull)
+
+
+@functools.lru_cache(maxsize=None)
+def getmtime(f, na=mintime):
     """
-    Wrapper to os.path.getmtime, returning -inf if a file doesn't exist.
+    Returns the mtime of f in integer nanoseconds.
 
     The optional argument na controls what is returned for files that don't
-    exist.
+    exist. Results are memoized; the main loop clears the cache whenever a
+    child process may have rewritten files.
     """
     try:
-        t = os.path.getmtime(f)
+        t = os.stat(f).st_mtime_ns
     except OSError:
         t = na
     return t
@@ -328,9 +680,9 @@ def getfullpaths(files, pdir=None, empty=False):
     return fullpaths
 
 
-def safemax(x,empty=-float("inf")):
+def safemax(x,empty=mintime):
     """
-    Maximum of list x with optional value in case x is empty (default: -inf).
+    Maximum of list x with optional value in case x is empty (default: mintime).
     """
     if len(x) == 0:
         return empty
@@ -338,9 +690,9 @@ def safemax(x,empty=-float("inf")):
         return max(x)
 
 
-def safemin(x,empty=float("inf")):
+def safemin(x,empty=maxtime):
     """
-    Minimum of list x with optional value in case x is empty (default: inf).
+    Minimum of list x with optional value in case x is empty (default: maxtime).
     """
     if len(x) == 0:
         return empty
@@ -348,6 +700,10 @@ def safemin(x,empty=float("inf")):
         return min(x)
 
 
+# Regex to find the beamer total frame count in aux files.
+framenumre = re.compile(rb"\\inserttotalframenumber\s\{(\d+)\}")
+
+
 def checktotalslides(auxfile):
     """
     Scans an aux file for \inserttotalframenumber and returns number of frames.
@@ -357,40 +713,225 @@ def checktotalslides(auxfile):
     """
     retval = None
     if os.path.isfile(auxfile):
-        with openlog(auxfile) as aux:
-            for line in aux:
-                m = re.search(r"\\inserttotalframenumber\s\{(\d+)\}", line)
+        with openmapped(auxfile) as buf:
+            # The literal is rare, so look for it with a plain bytes search
+            # and only run the regex if it is actually there.
+            idx = buf.find(b"\\inserttotalframenumber")
+            if idx >= 0:
+                m = framenumre.search(buf, idx)
                 if m is not None:
                     retval = int(m.group(1))
                     console.debug("Found inserttotalframenumber: %s", retval)
     return retval
 
 
-def md5sum(filename, block=128):
+def filehash(filename):
     """
-    Returns md5 digest of a file.
+    Returns a hash digest of a file.
+
+    The digest is used only for change detection, so we favor speed over
+    cryptographic strength (blake2b is noticeably faster than md5 on large
+    files). The file is memory mapped, so the hash reads straight out of
+    the page cache with no intermediate bytes object. The digest string is
+    prefixed with the algorithm name so digests from different algorithms
+    never compare equal.
     """
-    md5 = hashlib.md5()
-    with open(filename, "rb") as f:
-        for chunk in iter(lambda: f.read(block*md5.block_size), b""):
-            md5.update(chunk)
-    return md5.hexdigest()
+    import hashlib
+    hasher = hashlib.blake2b()
+    with openmapped(filename) as buf:
+        hasher.update(buf)
+    return "blake2b:" + hasher.hexdigest()
+md5sum = filehash # Old name.
 
 
-# Create a namedtuple for storing aux file information.
-AuxFile = collections.namedtuple("AuxFile", ["relpath", "exists", "timestamp",
-                                             "bibdata", "md5"])
+class HashThunk:
+    """
+    File hash that is only computed when it is actually needed.
+
+    Calling get() (or comparing against another HashThunk or digest string)
+    computes the digest on first use and caches it. Because timestamp
+    comparisons usually settle whether a file changed, most thunks are never
+    evaluated, which skips the file read and hash entirely.
+    """
+    def __init__(self, filename):
+        """Stores the filename. No hashing is performed yet."""
+        self.filename = filename
+        self.digest = None
+
+    def get(self):
+        """Returns the digest, computing and caching it on first use."""
+        if self.digest is None:
+            self.digest = filehash(self.filename)
+        return self.digest
+
+    def __eq__(self, other):
+        if self is other:
+            # Same thunk on both sides means the (mtime, size) cache already
+            # proved the file unchanged, so skip hashing altogether.
+            return True
+        elif isinstance(other, HashThunk):
+            other = other.get()
+        elif not isinstance(other, str):
+            return NotImplemented
+        return self.get() == other
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+
+class AuxWatcher:
+    """
+    Watches the build directory for files modified during a pdflatex run.
+
+    Uses inotify via the optional inotify_simple package. If that is not
+    available (or the watch cannot be created), changed() returns None,
+    meaning "anything may have changed", and callers should fall back to a
+    full rescan.
+    """
+    def __init__(self, pdir):
+        """Starts watching pdir for files written or moved into place."""
+        self.pdir = pdir
+        self.inotify = None
+        if inotify_simple is not None:
+            try:
+                self.inotify = inotify_simple.INotify()
+                watchflags = (inotify_simple.flags.CLOSE_WRITE
+                              | inotify_simple.flags.MOVED_TO)
+                self.inotify.add_watch(pdir, watchflags)
+            except OSError:
+                self.inotify = None
+
+    def changed(self):
+        """
+        Returns the set of full paths modified since watching started.
+
+        Returns None if inotify is not available or if the kernel dropped
+        events (queue overflow), in which case the set would be incomplete.
+        Note the watch is not recursive: only writes directly in pdir are
+        seen, so callers must not treat files in subdirectories as
+        untouched just because they are absent here.
+        """
+        if self.inotify is None:
+            return None
+        touched = set()
+        for event in self.inotify.read(timeout=0):
+            if event.mask & inotify_simple.flags.Q_OVERFLOW:
+                return None
+            if event.name:
+                touched.add(os.path.normpath(os.path.join(self.pdir,
+                                                          event.name)))
+        return touched
+
+    def close(self):
+        """Stops watching."""
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+
+
+def getanchor(pattern):
+    """
+    Returns the longest guaranteed literal substring of a regex pattern.
+
+    The anchor is used as a cheap prescan: if it does not appear in the
+    text, the full regex cannot match either. Escape sequences end a literal
+    run, and a character followed by ? or * or { is dropped from its run
+    since it is not guaranteed to appear. The contents of [...] classes,
+    {m,n} repetition counts, and (...) groups are skipped outright (a group
+    may hide an alternation), and a top-level | means no single literal is
+    guaranteed at all, so the empty string is returned, which disables the
+    prescan. The same happens if the pattern simply has no literal run.
+    """
+    best = ""
+    current = ""
+    i = 0
+    n = len(pattern)
+
+    def skipclass(i):
+        """Returns the index just past the [...] class starting at i."""
+        i += 1
+        if i < n and pattern[i] == "^":
+            i += 1
+        if i < n and pattern[i] == "]":
+            i += 1
+        while i < n and pattern[i] != "]":
+            i += 2 if pattern[i] == "\\" else 1
+        return i + 1
+
+    while i < n:
+        c = pattern[i]
+        if c == "\\":
+            # Escape sequence: ends the current literal run.
+            best = max(best, current, key=len)
+            current = ""
+            i += 2
+            continue
+        elif c == "|":
+            # Top-level alternation: neither branch is guaranteed.
+            return ""
+        elif c in "?*{":
+            best = max(best, current[:-1], key=len)
+            current = ""
+            if c == "{":
+                # Skip the repetition count; its digits are not literals.
+                end = pattern.find("}", i)
+                i = n if end < 0 else end
+        elif c == "[":
+            # A class matches one of several characters, so none of its
+            # contents are guaranteed.
+            best = max(best, current, key=len)
+            current = ""
+            i = skipclass(i)
+            continue
+        elif c == "(":
+            # A group may contain alternations (or just extension syntax
+            # like ?P<name>), so skip to its matching parenthesis without
+            # collecting anything, minding escapes, classes, and nesting.
+            best = max(best, current, key=len)
+            current = ""
+            depth = 1
+            i += 1
+            while i < n and depth > 0:
+                if pattern[i] == "\\":
+                    i += 2
+                elif pattern[i] == "[":
+                    i = skipclass(i)
+                else:
+                    if pattern[i] == "(":
+                        depth += 1
+                    elif pattern[i] == ")":
+                        depth -= 1
+                    i += 1
+            continue
+        elif c in "^$.+)}":
+            best = max(best, current, key=len)
+            current = ""
+        else:
+            current += c
+        i += 1
+    return max(best, current, key=len)
+
 
 class ErrorChecker:
-    """Uses regexes to search for error messages in log files."""
+    """
+    Uses regexes to search for error messages in log files.
+
+    The registered checks are combined into one union regex with a named
+    group per check, so classifying a log is a single pass of the engine
+    over the whole buffer rather than one search per check per line. Checks
+    can match anywhere in a line, which a fixed-prefix classifier could not
+    handle (e.g. "Package foo Warning:" after wrapped output).
+    """
     def __init__(self, defaultlevel="error"):
         """Initialize the object."""
         self.__checks = {}
         self.__Check = collections.namedtuple("Check", ["regex", "level",
-                                                        "lines"])
+                                                        "lines", "anchor"])
+        self.__union = None
         self.defaultlevel = defaultlevel
 
-    def add(self, regex=None, *, level=None, lines=1, name=None):
+    def add(self, regex=None, *, level=None, lines=1, name=None, anchor=None):
         """
         Adds a new or modifies an existing regex to look for.
 
@@ -398,7 +939,9 @@ class ErrorChecker:
         be given a string name that allows you to modify it later. Other
         options error decides whether the message indicates an error that
         should be printed, and if so, lines says how many lines from the log
-        file should be printed.
+        file should be printed. anchor gives a literal substring that must
+        appear for the regex to match; by default it is derived from the
+        pattern itself.
 
         Returns the name given to the regex.
         """
@@ -414,8 +957,13 @@ class ErrorChecker:
         if level is None:
             level = self.defaultlevel
 
-        # Add the new tuple and return name.
-        self.__checks[name] = self.__Check(re.compile(regex), level, lines)
+        # Add the new tuple and return name. The union regex must be rebuilt
+        # to include the new pattern.
+        if anchor is None:
+            anchor = getanchor(regex)
+        self.__checks[name] = self.__Check(re.compile(regex), level, lines,
+                                           anchor)
+        self.__union = None
         return name
 
     def change(self, name, *, level=None, lines=None):
@@ -431,27 +979,65 @@ class ErrorChecker:
             level = default.level
         if lines is None:
             lines = default.lines
-        self.__checks[name] = self.__Check(default.regex, level, lines)
+        self.__checks[name] = self.__Check(default.regex, level, lines,
+                                           default.anchor)
 
-    def search(self, logfile):
+    def getunion(self):
+        """
+        Returns (regex, groups, anchors) combining all patterns.
+
+        The combined regex wraps each pattern in a named group; groups maps
+        group names back to check names so that matches can be dispatched to
+        the right check. anchors is a tuple of the literal anchor substrings
+        (or None if any check lacks one, disabling the prescan). The result
+        is computed once and reused until a new pattern is added.
+        """
+        if self.__union is None:
+            groups = {}
+            patterns = []
+            anchors = []
+            for (i, (name, check)) in enumerate(self.__checks.items()):
+                group = "c{:d}".format(i)
+                groups[group] = name
+                patterns.append("(?P<{}>{})".format(group,
+                                                    check.regex.pattern))
+                anchors.append(check.anchor)
+            anchors = None if "" in anchors else tuple(anchors)
+            self.__union = (re.compile("|".join(patterns)), groups, anchors)
+        return self.__union
+
+    def search(self, logfile, data=None):
         """
         Searches logfile for the messages and returns errors and warnings.
 
         Return value is a dict whose keys are the levels of each error and
-        whose values are lists of the error messages.
+        whose values are lists of the error messages. If data is given, it is
+        used as the (bytes) log contents instead of reading logfile again.
         """
         messages = collections.defaultdict(list)
-        with openlog(logfile) as log:
-            for line in log:
-                for check in self.__checks.values():
-                    m = check.regex.search(line)
-                    if m is not None:
-                        # Match found. Get any extra lines.
-                        match = [line.strip("\n")]
-                        for n in range(check.lines - 1):
-                            match.append(next(log, "").strip("\n"))
-                        match = "\n".join(match)
-                        messages[check.level].append(match)
+        (union, groups, anchors) = self.getunion()
+        if data is None:
+            text = readlog(logfile)
+        else:
+            text = data.decode("ascii", errors="replace")
+
+        # Most logs contain none of the trigger strings, so check for the
+        # literal anchors first (C-speed substring search) and skip the
+        # regex scan entirely when none are present.
+        if anchors is not None and not any(a in text for a in anchors):
+            return messages
+        for m in union.finditer(text):
+            # Match found. Look up the check and slice out the matched line
+            # plus any extra lines it wants.
+            check = self.__checks[groups[m.lastgroup]]
+            start = text.rfind("\n", 0, m.start()) + 1
+            end = text.find("\n", m.end())
+            if end < 0:
+                end = len(text)
+            for n in range(check.lines - 1):
+                nextend = text.find("\n", end + 1)
+                end = len(text) if nextend < 0 else nextend
+            messages[check.level].append(text[start:end])
         return messages
 
 # Regexes to search log file. Give a name to items that we may want to
@@ -480,6 +1066,12 @@ blgchecker.add(r"I was expecting a .* or a .*---line \d* of file", lines=5)
 blgchecker.add("Warning--entry type for .* isn't style-file defined", lines=2)
 blgchecker.add("I couldn't open database file", lines=4)
 
+# Compile the union regexes now that all the checks are registered, so the
+# first search in the main loop doesn't pay the compile cost. change() only
+# adjusts levels and does not invalidate the unions.
+logchecker.getunion()
+blgchecker.getunion()
+
 class StatusConsole:
     """Lightweight logging class to print progress."""
     def __init__(self, status=True, errors=True, debug=False, critical=True):
@@ -583,6 +1175,13 @@ class CitationIndex:
 
         self.keeptext = set(string.ascii_letters + string.digits + " ")
 
+        # Translation table that keeps characters in keeptext and deletes
+        # everything else (characters missing from the table map to None).
+        class KeepTable(dict):
+            def __missing__(self, key):
+                return None
+        self.keeptable = KeepTable((ord(c), c) for c in self.keeptext)
+
         self.replacements = [
             (r"\OE", "OE"),
             (r"\aa", "a"),
@@ -598,6 +1197,15 @@ class CitationIndex:
             ("~", " ")
         ]
 
+        # Fuse all of the replacements into a single regex pass. Earlier
+        # entries win, matching the old one-replace-at-a-time behavior.
+        repldict = {}
+        for (find, repl) in self.replacements:
+            repldict.setdefault(find, repl)
+        self.repldict = repldict
+        self.replacere = re.compile("|".join(re.escape(find)
+                                             for find in repldict))
+
     def nobracespace(self, s):
         """
         Gets rid of whitespace immediately inside braces.
@@ -606,19 +1214,14 @@ class CitationIndex:
         s = self.spaceafterre.sub("}", s)
         return s
 
-    def keep(self, s):
-        """Returns true or false whether s is in KEEPTEXT."""
-        return (s in self.keeptext)
-
     def purify(self, name):
         """
         Returns "purified" version of name.
         """
         name = self.nobracespace(name)
-        for (find, repl) in self.replacements:
-            name = name.replace(find, repl)
+        name = self.replacere.sub(lambda m: self.repldict[m.group(0)], name)
         name = self.tokenre.sub("", name)
-        name = str(filter(self.keep, name))
+        name = name.translate(self.keeptable)
         return name.upper()
 
     def clean(self, infilename, outfilename=None):
@@ -626,6 +1229,7 @@ class CitationIndex:
         Makes a clean citationindex from infile.
         """
         # Choose output file.
+        import tempfile
         if outfilename is None:
             indir = os.path.split(infilename)[0]
             kwargs = dict(dir=indir, prefix="authorindex_", delete=False)
@@ -681,14 +1285,12 @@ def main(*args):
     # Break out some arguments.
     displayOptions = {
         #     (some display, error display, stdout)
-        "none" : (False, False, os.devnull),
-        "some" : (True, False, os.devnull),
-        "errors" : (True, True, os.devnull),
+        "none" : (False, False, subprocess.DEVNULL),
+        "some" : (True, False, subprocess.DEVNULL),
+        "errors" : (True, True, subprocess.DEVNULL),
         "all" : (True, True, None),
     }
     (somedisplay, errordisplay, stdout) = displayOptions[options["display"]]
-    if stdout is not None:
-        stdout = open(stdout, "w")
 
     # Set console options for printing.
     debug = options["debug"]
@@ -736,34 +1338,111 @@ def main(*args):
     # Check aux file to see if there is an \inserttotalframenumber anywhere.
     beamer_numslides = checktotalslides(extrafile["aux"])
 
+    # If the previous invocation succeeded and nothing has changed since,
+    # there is nothing to do at all. Otherwise, seed the aux cache from the
+    # saved state so the first iteration skips re-reading unchanged files.
+    usestate = not options["no_state_file"]
+    if usestate:
+        state = loadstate(fullbuilddir)
+        if (options["min_runs"] <= 1
+                and stateuptodate(state, fullfilename, extrafile["pdf"])):
+            console.status("<{}> is up to date", os.path.relpath(
+                extrafile["pdf"], fullbuilddir))
+            return
+        seedauxcache(state)
+
     # Now start the main loop.
     keepgoing = True
-    auxinfo = {}
+    usedraft = not options["no_draftmode"]
+    lastrunwasdraft = False
+    auxinfo = AuxInfo()
+    newauxinfo = auxinfo
+    fullbib = []
     indexfiles = {}
+    import concurrent.futures
+    prevfingerprint = None
+    dirfiles = None
+    dirmtime = mintime
     for runcount in range(1, maxruns + 1):
-        # Run bibtex if any bib files are found.
-        for (f, a) in auxinfo.items():
-            if len(a.bibdata) > 0:
-                # We need to make sure each file is passed with a relative
-                # filename or else bibtex will complain because it doesn't want
-                # to open any files outside of its working directory. So, we
-                # check if the input is an absolute path, and if so, we make it
-                # a relative path.
-                if a.relpath.startswith(".."):
-                    console.critical("Warning: file <{}> is not within "
-                                     "directory <{}>. Bibtex will likely "
-                                     "error.", a.relpath, fullbuilddir)
-
-                console.status("running bibtex on <{}>", a.relpath)
-                bibtex = subprocess.Popen(["bibtex",a.relpath],
-                                          cwd=fullbuilddir, stdout=stdout,
-                                          env=pdflatexenv)
-                bibtex.wait()
-                if bibtex.returncode != 0:
-                    console.error("bibtex error [Code {:d}].",
-                                  bibtex.returncode)
+        # Children spawned last iteration (or the state-file read) may have
+        # left stale mtimes behind.
+        getmtime.cache_clear()
+
+        # Get a list of all aux files in the build directory and information
+        # including timestamps, any \bibdata entries, and possibly digests.
+        # We get the list of files from the previous auxinfo dict. If this is
+        # the first run, we need a guess for all the auxiliary files we might
+        # need. We first take all the files currently in the build directory.
+        # Then, if the log file exists, we search for additional aux files. If
+        # this is a subsequent run, we can just use the files found before.
+        # Only pdflatex ever writes the aux files, so this scan runs on a
+        # helper thread while bibtex and makeindex do their work below.
+        def scanoldaux():
+            """Returns pre-run aux info, pinning digests if paranoid."""
+            if runcount == 1:
+                (dirfiles, dirstats) = scandirstats(fullbuilddir)
+                scanfiles = itertools.chain([extrafile["aux"]], dirfiles)
+                if os.path.isfile(extrafile["log"]):
+                    scanfiles = itertools.chain(
+                        scanfiles, getauxfromlog(extrafile["log"],
+                                                 pdir=fullbuilddir))
+            else:
+                scanfiles = auxinfo
+                dirstats = None
+            old = getauxinfo(scanfiles, pdir=fullbuilddir,
+                             digest=options["paranoid"], stats=dirstats)
+
+            # Hashes are computed lazily, but the old digests have to be
+            # pinned down before pdflatex rewrites the files. Thunks carried
+            # over from the previous iteration are already evaluated, so this
+            # mostly hits the cache; the remainder is hashed in parallel,
+            # since blake2b releases the GIL and the work is read-and-hash
+            # per file.
+            if options["paranoid"]:
+                pending = [thunk for thunk in old.digest.values()
+                           if thunk is not None and thunk.digest is None]
+                if len(pending) > 1:
+                    hashpool = concurrent.futures.ThreadPoolExecutor(
+                        options["jobs"])
+                    with hashpool:
+                        list(hashpool.map(HashThunk.get, pending))
+                elif pending:
+                    pending[0].get()
+            return old
+        scanpool = concurrent.futures.ThreadPoolExecutor(1)
+        oldscan = scanpool.submit(scanoldaux)
+
+        # Run bibtex if any bib files are found. Each aux file is processed
+        # by an independent bibtex process, so they are run concurrently.
+        bibjobs = [auxinfo.relpath[f] for f in auxinfo
+                   if len(auxinfo.bibdata[f]) > 0]
+        for relpath in bibjobs:
+            # We need to make sure each file is passed with a relative
+            # filename or else bibtex will complain because it doesn't want
+            # to open any files outside of its working directory. So, we
+            # check if the input is an absolute path, and if so, we make it
+            # a relative path.
+            if relpath.startswith(".."):
+                console.critical("Warning: file <{}> is not within "
+                                 "directory <{}>. Bibtex will likely "
+                                 "error.", relpath, fullbuilddir)
+            console.status("running bibtex on <{}>", relpath)
+        def runbibtex(relpath):
+            """Runs bibtex on one aux file and returns (relpath, code)."""
+            bibtex = runcommand(["bibtex",relpath],
+                                cwd=fullbuilddir, stdout=stdout,
+                                env=pdflatexenv)
+            return (relpath, bibtex.returncode)
+        if len(bibjobs) > 0:
+            nworkers = min(options["jobs"], len(bibjobs))
+            with concurrent.futures.ThreadPoolExecutor(nworkers) as pool:
+                bibresults = pool.map(runbibtex, bibjobs)
+            for (relpath, returncode) in sorted(bibresults):
+                if returncode != 0:
+                    console.error("bibtex error in <{}> [Code {:d}].",
+                                  relpath, returncode)
                     if errordisplay:
-                        blgfile = re.sub("\\.aux$", ".blg", a.relpath)
+                        blgfile = re.sub("\\.aux$", ".blg", relpath)
                         absblgfile = os.path.join(fullbuilddir, blgfile)
                         try:
                             blgmessages = blgchecker.search(absblgfile)
@@ -774,7 +1453,11 @@ def main(*args):
                         console.multiprint(blgmessages)
 
         # Run makeindex on any indices that are found. Note special behavior
-        # for author index.
+        # for author index. The preprocessing (authorindex, citation index
+        # cleanup) has to finish before its own makeindex starts, but the
+        # makeindex runs are independent of each other, so they are all
+        # launched first and joined afterwards.
+        indexprocs = []
         for (indextype, (inext, outext)) in indexfiles.items():
             if os.path.isfile(extrafile[inext]):
                 console.debug("building {} file.", outext)
@@ -782,16 +1465,15 @@ def main(*args):
                 # If this is an author index, we have to run authorindex first.
                 if indextype == "author":
                     console.status("running authorindex")
-                    auxfiles = list(auxinfo.keys())
+                    auxfiles = list(auxinfo)
                     args = ["authorindex", "-i", "-r", basefilename] + auxfiles
-                    makeauthor = subprocess.Popen(args, cwd=fullbuilddir,
-                                                  stdout=stdout, stderr=stdout)
-                    makeauthor.wait()
+                    runcommand(args, cwd=fullbuilddir, stdout=stdout,
+                               stderr=stdout)
 
                 elif indextype == "citation":
                     citationindex.clean(extrafile[inext])
 
-                # Now run makeindex.
+                # Now launch makeindex.
                     console.status("cleaning citation index")
                 console.status("running makeindex")
                 [relin, relout] = [os.path.relpath(extrafile[k], fullbuilddir)
@@ -801,60 +1483,115 @@ def main(*args):
                                     "directory <{}>. Makeindex will likely "
                                     "error.", relin, fullbuilddir)
                 args = ["makeindex", "-o", relout, relin]
-                makeindex = subprocess.Popen(args, cwd=fullbuilddir,
-                                             stdout=stdout, # Makeindex uses
-                                             stderr=stdout) # stderr
-                makeindex.wait()
-
-
-        # Get a list of all aux files in the build directory and information
-        # including timestamps, any \bibdata entries, and possibly md5 sums.
-        # We get the list of files from the previous auxinfo dict. If this is
-        # the first run, we need a guess for all the auxiliary files we might
-        # need. We first take all the files currently in the build directory.
-        # Then, if the log file exists, we search for additional aux files. If
-        # this is a subsequent run, we can just use the files found before.
-        if runcount == 1:
-            auxfiles = [extrafile["aux"]] + os.listdir(fullbuilddir)
-            if os.path.isfile(extrafile["log"]):
-                auxfiles += getauxfromlog(extrafile["log"], pdir=fullbuilddir)
-        else:
-            auxfiles = list(auxinfo.keys())
-        oldauxinfo = getauxinfo(auxfiles, pdir=fullbuilddir,
-                                md5=options["paranoid"])
-
-        # Now run pdflatex.
+                proc = subprocess.Popen(args, cwd=fullbuilddir,
+                                        stdout=stdout, # Uses stderr.
+                                        stderr=stdout, close_fds=False)
+                indexprocs.append((relin, proc))
+        for (relin, proc) in indexprocs:
+            if proc.wait() != 0:
+                console.error("makeindex error in <{}> [Code {:d}].",
+                              relin, proc.returncode)
+
+        # Collect the pre-run aux scan started above.
+        oldauxinfo = oldscan.result()
+        scanpool.shutdown()
+
+        # The pinned digests give a complete picture of the pre-run aux
+        # state. If it is identical to the state before the previous run,
+        # the intermediate runs can only reproduce what they already
+        # produced, so skip straight to the final run (full pdf output and
+        # final-run message levels) instead of burning the runs in between.
+        lastrun = runcount == maxruns
+        if options["paranoid"]:
+            fingerprint = tuple(sorted(
+                (oldauxinfo.relpath[f], oldauxinfo.bibdata[f],
+                 None if oldauxinfo.digest[f] is None
+                 else oldauxinfo.digest[f].digest)
+                for f in oldauxinfo))
+            if runcount > minruns and fingerprint == prevfingerprint:
+                console.debug("aux files reached a fixed point. Skipping "
+                              "ahead to the final run.")
+                lastrun = True
+            prevfingerprint = fingerprint
+
+        # Now run pdflatex. Intermediate runs only exist to converge the aux
+        # files, so they skip pdf generation with --draftmode; once
+        # everything has settled, one final run without it produces the
+        # actual pdf.
+        lastrunwasdraft = usedraft and not lastrun
+        draftflag = ["--draftmode"] if lastrunwasdraft else []
         console.status("running pdflatex ({:d})", runcount)
 
-        pdflatex = subprocess.Popen(pdflatexargs + [fullfilename],
-                                    cwd=fullbuilddir, stdout=stdout,
-                                    env=pdflatexenv)
-        pdflatex.wait()
+        watcher = AuxWatcher(fullbuilddir)
+        t0 = time.time_ns()
+        pdflatex = runcommand(pdflatexargs + draftflag + [fullfilename],
+                              cwd=fullbuilddir, stdout=stdout,
+                              env=pdflatexenv)
+        touched = watcher.changed()
+        watcher.close()
         keepgoing = (pdflatex.returncode != 0)
         if keepgoing:
             console.error("pdflatex error [Code {:d}]. Check log.",
                           pdflatex.returncode)
 
+        # Read the log once and share it among the scanners below; it is
+        # usually the largest file touched per iteration.
+        with openmapped(extrafile["log"]) as logbuf:
+            logdata = bytes(logbuf)
+
         # Check log file for any errors or warnings. If final run, display
         # undefined citations as errors.
-        if runcount == maxruns:
+        if lastrun:
             citeerror = "ignore" if options["ignore_cite_errors"] else "error"
             for k in ["undef", "undefref", "undefcite"]:
                 logchecker.change(k, level=citeerror)
-        logmessages = logchecker.search(extrafile["log"])
+        logmessages = logchecker.search(extrafile["log"], data=logdata)
         console.multiprint(logmessages)
         if any(len(logmessages[k]) > 0 for k in ["warning", "error", "fatal"]):
             keepgoing = True
 
-        # Update info for aux files.
-        auxfiles = [extrafile["aux"]] + getauxfromlog(extrafile["log"],
-                                                      pdir=fullbuilddir)
+        # Update info for aux files. If inotify told us which files pdflatex
+        # touched, files outside that set keep their pre-run entries and are
+        # not rescanned.
+        auxfiles = itertools.chain(
+            [extrafile["aux"]], getauxfromlog(extrafile["log"],
+                                              pdir=fullbuilddir,
+                                              data=logdata))
         if options["check_all_aux"]:
-            auxfiles += os.listdir(fullbuilddir)
-        newauxinfo = getauxinfo(auxfiles, pdir=fullbuilddir,
-                                md5=options["paranoid"])
+            # The listing only needs refreshing when the directory itself
+            # changed; creates, deletes, and renames bump its mtime, and
+            # in-place rewrites (which don't) can't alter the name list.
+            newdirmtime = os.stat(fullbuilddir).st_mtime_ns
+            if dirfiles is None or newdirmtime != dirmtime:
+                (dirfiles, dirstats) = scandirstats(fullbuilddir)
+                dirmtime = newdirmtime
+            else:
+                dirstats = None
+            auxfiles = itertools.chain(auxfiles, dirfiles)
+        else:
+            dirstats = None
+        if touched is None:
+            newauxinfo = getauxinfo(auxfiles, pdir=fullbuilddir,
+                                    digest=options["paranoid"], newerthan=t0,
+                                    stats=dirstats)
+        else:
+            newauxinfo = AuxInfo()
+            rescan = []
+            watchdir = os.path.normpath(fullbuilddir)
+            for f in getfullpaths(auxfiles, fullbuilddir):
+                # The watch only covers the build directory itself, so aux
+                # files in subdirectories (e.g. from \include) can never
+                # show up in touched and are always rescanned.
+                watched = os.path.dirname(f) == watchdir
+                if watched and f in oldauxinfo and f not in touched:
+                    newauxinfo.copyfrom(oldauxinfo, f)
+                else:
+                    rescan.append(f)
+            newauxinfo.update(getauxinfo(rescan, pdir=fullbuilddir,
+                                         digest=options["paranoid"],
+                                         newerthan=t0, stats=dirstats))
         auxinfo = getmodifiedaux(oldauxinfo, newauxinfo,
-                                 md5=options["paranoid"])
+                                 digest=options["paranoid"])
 
         # If first time, check log file to get auxiliary files with
         # bibliographies. Also check to see if the number of slides has
@@ -876,27 +1613,29 @@ def main(*args):
                     console.debug("Number of slides has changed.")
 
         # Look through log to get list of index files.
-        indexfiles = getindexfiles(extrafile["log"])
+        indexfiles = getindexfiles(extrafile["log"], data=logdata)
 
         # Now loop through aux files to see if bibinfo is different. Also,
-        # check md5 if the paranoid flag.
-        for (f, a) in auxinfo.items():
-            if len(a.bibdata) > 0:
-                if f in oldauxinfo and oldauxinfo[f].bibdata != a.bibdata:
+        # check digests if the paranoid flag.
+        for f in auxinfo:
+            if len(auxinfo.bibdata[f]) > 0:
+                if f in oldauxinfo and oldauxinfo.bibdata[f] != auxinfo.bibdata[f]:
                     keepgoing = True
-                    console.debug("bibdata changed in '{}'.", a.relpath)
+                    console.debug("bibdata changed in '{}'.",
+                                  auxinfo.relpath[f])
             if not keepgoing and options["paranoid"]:
                 if f not in oldauxinfo:
                     keepgoing = True
-                    console.debug("aux file '{}' is new.", a.relpath)
-                elif oldauxinfo[f].md5 != a.md5:
+                    console.debug("aux file '{}' is new.", auxinfo.relpath[f])
+                elif oldauxinfo.digest[f] != auxinfo.digest[f]:
                     keepgoing = True
-                    console.debug("md5 of '{}' has changed.", a.relpath)
+                    console.debug("digest of '{}' has changed.",
+                                  auxinfo.relpath[f])
 
         # Check all index files and make sure they are older than the tex file.
+        textime = getmtime(extrafile["tex"])
         for (_, ext) in indexfiles.values():
-            textime = getmtime(extrafile["tex"])
-            indextime = getmtime(extrafile[ext], na=float("inf"))
+            indextime = getmtime(extrafile[ext], na=maxtime)
             if textime >= indextime:
                 keepgoing = True
                 console.debug("{} file is out of date.", ext)
@@ -912,13 +1651,37 @@ def main(*args):
             console.debug("No issues found. Stopping.")
             break
 
+        # If that was the final run, iterating further cannot help.
+        if lastrun:
+            break
+
+    # Intermediate runs used --draftmode and thus didn't write a pdf, so run
+    # pdflatex one final time to actually produce it.
+    if not keepgoing and lastrunwasdraft:
+        console.status("running pdflatex (final)")
+        pdflatex = runcommand(pdflatexargs + [fullfilename],
+                              cwd=fullbuilddir, stdout=stdout,
+                              env=pdflatexenv)
+        if pdflatex.returncode != 0:
+            keepgoing = True
+            console.error("pdflatex error [Code {:d}]. Check log.",
+                          pdflatex.returncode)
+
+    # Record the final state so the next invocation can skip converged
+    # builds outright. The final pdflatex run just rewrote the pdf, so drop
+    # any memoized mtimes first.
+    getmtime.cache_clear()
+    if usestate:
+        savestate(fullbuilddir, fullfilename, extrafile["pdf"], newauxinfo,
+                  fullbib, success=not keepgoing)
+
     # Now see if everything worked properly.
     if keepgoing:
         if not options["keep_pdf_timestamp"]:
             # Change modification time for pdf file.
             if all(os.path.isfile(extrafile[ext]) for ext in ["pdf", "tex"]):
-                mtime = os.path.getmtime(extrafile["tex"]) - 1
-                os.utime(extrafile["pdf"], (mtime, mtime))
+                mtime = getmtime(extrafile["tex"]) - 10**9
+                os.utime(extrafile["pdf"], ns=(mtime, mtime))
         errorout("Errors persist after {:d} runs".format(runcount),
                  doc=False, usage=False)
     else:
@@ -932,6 +1695,7 @@ if __name__ == "__main__":
         sys.exit(0)
     except Exception as err:
         if console.show_debug:
+            import traceback
             traceback.print_exc()
         console.critical(str(err))
         sys.exit(1)